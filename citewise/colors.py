@@ -4,8 +4,11 @@
 
 import sys
 import os
+import functools
 
-from difflib import SequenceMatcher
+# Use the C implementation of SequenceMatcher from cdifflib, if available.
+try: from cdifflib import CSequenceMatcher as SequenceMatcher
+except ImportError: from difflib import SequenceMatcher
 
 config = {
     'ui': {
@@ -22,12 +25,6 @@ config = {
     },
 }
 
-# On Windows platforms, use colorama to support "ANSI" terminal colors.
-if sys.platform == 'win32':
-    try: import colorama
-    except ImportError: pass
-    else: colorama.init()
-
 COLOR_ESCAPE = "\x1b["
 DARK_COLORS = {
     "black": 0,
@@ -56,23 +53,43 @@ LIGHT_COLORS = {
 }
 RESET_COLOR = COLOR_ESCAPE + "39;49;00m"
 
+# Escape sequences for every color in DARK_COLORS and LIGHT_COLORS
+_ESCAPES = {name: COLOR_ESCAPE + "%im" % (value + 30)
+            for name, value in DARK_COLORS.items()}
+_ESCAPES.update({name: COLOR_ESCAPE + "%i;01m" % (value + 30)
+                 for name, value in LIGHT_COLORS.items()})
+
 # These abstract COLOR_NAMES are lazily mapped on to the actual color in COLORS
 # as they are defined in the configuration files, see function: colorize
 COLOR_NAMES = ['text_success', 'text_warning', 'text_error', 'text_highlight',
                'text_highlight_minor', 'action_default', 'action']
 COLORS = None
 
+# Whether colorama has been set up, see function: init_colorama
+_colorama_inited = False
+
+
+def init_colorama():
+    """On Windows platforms, use colorama to support "ANSI" terminal colors.
+    Only done once, in the process writing to the terminal.
+    """
+    global _colorama_inited
+    if not _colorama_inited:
+        _colorama_inited = True
+        if sys.platform == 'win32':
+            try: import colorama
+            except ImportError: pass
+            else: colorama.init()
+
 
 def _colorize(color, text):
     """Returns a string that prints the given text in the given color
     in a terminal that is ANSI color-aware. The color must be something
     in DARK_COLORS or LIGHT_COLORS.
     """
-    if color in DARK_COLORS:
-        escape = COLOR_ESCAPE + "%im" % (DARK_COLORS[color] + 30)
-    elif color in LIGHT_COLORS:
-        escape = COLOR_ESCAPE + "%i;01m" % (LIGHT_COLORS[color] + 30)
-    else:
+    try:
+        escape = _ESCAPES[color]
+    except KeyError:
         raise ValueError('no such color %s', color)
     return escape + text + RESET_COLOR
 
@@ -84,6 +101,8 @@ def colorize(color_name, text):
     if not config['ui']['color'] or 'NO_COLOR' in os.environ.keys():
         return text
 
+    init_colorama()
+
     global COLORS
     if not COLORS:
         COLORS = {name:
@@ -120,10 +139,14 @@ def _colordiff(a, b, highlight='text_highlight',
         a = util.displayable_path(a)
         b = util.displayable_path(b)
 
+    if a == b:
+        # Nothing to highlight.
+        return a, b
+
     a_out = []
     b_out = []
 
-    matcher = SequenceMatcher(lambda x: False, a, b)
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
     for op, a_start, a_end, b_start, b_end in matcher.get_opcodes():
         if op == 'equal':
             # In both strings.
@@ -150,11 +173,20 @@ def _colordiff(a, b, highlight='text_highlight',
     return ''.join(a_out), ''.join(b_out)
 
 
+@functools.lru_cache(maxsize=1024)
+def _colordiff_cached(a, b, highlight):
+    """Memoized _colordiff for pairs of strings, which tend to repeat.
+    """
+    return _colordiff(a, b, highlight)
+
+
 def colordiff(a, b, highlight='text_highlight'):
     """Colorize differences between two values if color is enabled.
     (Like _colordiff but conditional.)
     """
     if config['ui']['color']:
+        if isinstance(a, str) and isinstance(b, str):
+            return _colordiff_cached(a, b, highlight)
         return _colordiff(a, b, highlight)
     else:
         return str(a), str(b)
@@ -1,107 +1,223 @@
 #!/usr/bin/env python3
 import argparse
+import functools
+import multiprocessing
 import sys
 import re
 
 from citewise.biblib import bib as biblib
 from citewise.biblib import algo as bibalg
-
-import pyiso4
-from pyiso4.ltwa import Abbreviate
+from citewise.biblib import messages as bibmsg
 
 from citewise import colors
 
+# Patterns used when processing journal and conference names
+_RE_YEAR = re.compile(r"(?P<yrpfx>.*\s\d{2,4}\s?[:\-–—]\s+)|(?P<yr>(\d{4}|'\d{2})[.,;]?)")
+_RE_TRAIL_ACR = re.compile(r'(\s+\(.+\)|[,;:\-–—]\s+\S+)\s*$')
+_RE_TITLE = re.compile(r'\b[a-z]{4,}')
+_RE_ORDER_NUM = re.compile(r'\d+(st|nd|rd|th)\s+', re.IGNORECASE)
+_RE_ORDER_WORD = re.compile(r'\S*(first|second|third|fourth|fifth|sixth|seventh|eight|ninth|tenth|tieth|dredth)\s+', re.IGNORECASE)
+_RE_ANNUAL = re.compile(r'(Annual)\s+', re.IGNORECASE)
+_RE_PROC = re.compile(r'(Proceedings)\s*(of the)?\s+', re.IGNORECASE)
+_RE_WS = re.compile(r'\s+')
+_RE_BAD_ABBREV = re.compile(r'(?<!\S)(\S+)\.(?!\S)')
+_SKIP_JOURNALS = re.compile(r'arXiv|PapersOnLine')
+_PROC_WORD = re.compile(r'(?<!\S)Proceedings(?!\S)')
+_TEX_SPECIAL = re.compile(r'[\\{}~\f$&#^_]|--')
+_STRIP_PUNCT = str.maketrans('', '', ',;:')
+
+# Fields to clear for all entries, and additionally for articles and proceedings
+_CLEAR_COMMON = frozenset('shorttitle abstract pages keywords copyright note langid language urldate timestamp file groups'.split())
+_CLEAR_ARTICLE = _CLEAR_COMMON | frozenset('editor publisher'.split())
+_CLEAR_INPROC = _CLEAR_COMMON | frozenset('editor publisher address series booktitleaddon eventtitle volume'.split())
+
+# Abbreviate object, created once per process in _init_worker()
+_ABBR = None
+
+def _tex(s):
+
+    # Only run the TeX parser if there is anything for it to convert
+    if not _TEX_SPECIAL.search(s): return s
+    return bibalg.tex_to_unicode(s)
+
+@functools.lru_cache(maxsize=4096)
+def _apply_iso4(s):
+
+    # Remove any additional punctuation
+    s = s.translate(_STRIP_PUNCT)
+
+    # Apply abbreviation
+    abbr = _ABBR(s + ' ')
+
+    # Fix cases where abbreviation are equal to the original word
+    orig_words = set(s.split())
+    return _RE_BAD_ABBREV.sub(
+        lambda m : m.group(1) if m.group(1) in orig_words else m.group(0), abbr)
+
+@functools.lru_cache(maxsize=4096)
 def abbrev_journal(string, abbr=True):
 
     # Skip certain journals
-    known_issues = 'arXiv PapersOnLine'.split()
-    for name in known_issues:
-        if name in string: return string
+    if _SKIP_JOURNALS.search(string): return string
 
-    # Create list for every new step
-    process = [string]
+    s = string
 
     if abbr:
+        s = _apply_iso4(s)
 
-        # Remove any additional punctuation
-        process.append( re.sub('[\,\;\:]', '', process[-1]) )
-
-        # Apply abbreviation
-        process.append( abbreviate(process[-1]+' ') )
-
-        # Fix cases where abbreviation are equal to the original word
-        string_copy =  process[-1]
-        for word in process[-2].split(): # For all words in the unabbreviated string
-            bad_abbrev = word + '.'
-            if bad_abbrev in process[-1].split():
-                string_copy = string_copy.replace(bad_abbrev, word)
-        process.append( string_copy )
-
-    return process[-1]
+    return s
 
 
+@functools.lru_cache(maxsize=4096)
 def abbrev_conference(string, proc=None, annu=False, order=False, abbr=True):
 
-    # Create list for every new step
-    process = [string]
-
-    # Remove any "prefix" containing the year, e.g "IEEE INFOCOM 2017 - "
-    process.append( re.sub('.*\s\d{2,4}\s?[\:\-\–\—]\s+', '', process[-1]) )
+    s = string
 
-    # Remove all year (plus any punctuation), e.g. "2004."
-    process.append( re.sub('(\d{4}|\'\d{2})[\.\,\;]?', '', process[-1]) )
+    # Remove any "prefix" containing the year, e.g "IEEE INFOCOM 2017 - ",
+    # and all remaining years (plus any punctuation), e.g. "2004."
+    s = _RE_YEAR.sub('', s)
 
     # Remove trailing acronyms, e.g. " (CDC)", ", AAMAS", or " - WWW"
-    process.append( re.sub('(\s+\(.+\)|[\,\;\:\-\–\—]\s+\S+)\s*$', '', process[-1]) )
+    s = _RE_TRAIL_ACR.sub('', s)
 
     # Apply title case on lower-case words longer than 3 characters
-    process.append( re.sub(r'(\b)([a-z]{4,})',
-        lambda s : s.group(1) + s.group(2).title(), process[-1]) )
+    s = _RE_TITLE.sub(lambda m : m.group(0).title(), s)
 
     # Optional: Remove the number in the order, e.g. "4th", "Twenty-Sixth"
     if order:
-        if re.search('\d+(st|nd|rd|th)\s+', process[-1], flags=re.IGNORECASE):
-            process.append( re.sub('\d+(st|nd|rd|th)\s+', '', process[-1], flags=re.IGNORECASE) )
-        else:
-            process.append( re.sub('\S*(first|second|third|fourth|fifth|sixth|seventh|eight|ninth|tenth|tieth|dredth)\s+', '', process[-1], flags=re.IGNORECASE) )
+        s, n = _RE_ORDER_NUM.subn('', s)
+        if not n:
+            s = _RE_ORDER_WORD.sub('', s)
 
     # Optional: Remove "Annual"
     if annu:
-        process.append( re.sub('(Annual)\s+', '', process[-1], flags=re.IGNORECASE) )
+        s = _RE_ANNUAL.sub('', s)
 
     # Optional: Enforce/remove "Proceedings"
     if proc == 'remove':
-        process.append( re.sub('(Proceedings)\s*(of the)?\s+', '', process[-1], flags=re.IGNORECASE) )
-    elif proc != 'ignore' and 'Proceedings' not in process[-1].split():
-        process.append( 'Proceedings of the ' + process[-1] )
+        s = _RE_PROC.sub('', s)
+    elif proc != 'ignore' and not _PROC_WORD.search(s):
+        s = 'Proceedings of the ' + s
 
     # Optional: Apply ISO4 abbreviations
     if abbr:
-
-        # Remove additional punctuation
-        process.append( re.sub('[\,\;\:]', '', process[-1]) )
-
-        # Apply abbreviation
-        process.append( abbreviate(process[-1]+' ') )
-
-        # Fix cases where abbreviation are equal to the original word
-        string_copy =  process[-1]
-        for word in process[-2].split(): # For all words in the unabbreviated string
-            bad_abbrev = word + '.'
-            if bad_abbrev in process[-1].split():
-                string_copy = string_copy.replace(bad_abbrev, word)
-        process.append( string_copy )
+        s = _apply_iso4(s)
 
     # Clean up whitespaces
-    process.append( re.sub('\s+', ' ', process[-1]) )
-
-    return process[-1]
+    return _RE_WS.sub(' ', s)
+
+def _init_worker(abbrev):
+
+    # Create abbreviate object, only if needed since loading LTWA is slow
+    global _ABBR
+    if abbrev:
+        from pyiso4.ltwa import Abbreviate
+        _ABBR = Abbreviate.create()
+
+def _process_entry(ent, abbrev=True, proc=None, annu=True, order=True, quiet=False):
+
+    # List of changes to print
+    changes = []
+
+    # Fields to clear, depending on the entry type
+    if ent.typ == 'article': clear = _CLEAR_ARTICLE
+    elif ent.typ == 'inproceedings': clear = _CLEAR_INPROC
+    else: clear = _CLEAR_COMMON
+
+    # Clear unnecessary and empty fields in one pass
+    for key in list(ent.keys()):
+        if key in clear or not ent[key]:
+            del ent[key]
+
+    if ent.typ == 'techreport':
+        # It type not present, use default
+        try:
+            t = _tex(ent['type'])
+        except biblib.FieldError:
+            t = 'Technical Report'
+
+        # Abbreviate techrep type
+        if abbrev: t_abbrev = abbrev_journal(t)
+        else: t_abbrev = t
+
+        ent['type'] = '{' + t_abbrev + '}'
+
+        # Print changes
+        if not quiet and t != t_abbrev:
+            t_c, t_abbrev_c = colors.colordiff(t,t_abbrev)
+            changes.append(f'{t_c} -> {t_abbrev_c}')
+
+    if ent.typ == 'article':
+        # Abbreviate journal names
+        j = _tex(ent['journal'])
+        j_abbrev = abbrev_journal(j, abbrev)
+        ent['journal'] = j_abbrev
+
+        # Special treatment for ePrints
+        try:
+            if ent['eprint'] + ent['eprinttype'] + ent['primaryclass'] != None:
+                # Remove the journal field
+                ent.pop('journal', None)
+        except biblib.FieldError: pass
+
+        # Print changes
+        if not quiet and j != j_abbrev:
+            j_c, j_abbrev_c = colors.colordiff(j,j_abbrev)
+            changes.append(f'{j_c} -> {j_abbrev_c}')
+
+    elif ent.typ == 'inproceedings':
+        # Trim and abbreviate conference titles
+        conf = _tex(ent['booktitle'])
+        conf_abbrev = abbrev_conference(conf,
+            proc=proc, annu=annu, order=order, abbr=abbrev)
+        ent['booktitle'] = '{' + conf_abbrev + '}'
+
+        # Print changes
+        if not quiet and conf != conf_abbrev:
+            conf_c, conf_abbrev_c = colors.colordiff(conf,conf_abbrev)
+            changes.append(f'{conf_c} -> {conf_abbrev_c}')
+
+    return changes
+
+def _process_fields(item, **flags):
+
+    # Entries can't be pickled, so workers rebuild them from their fields
+    typ, key, fields = item
+    ent = biblib.Entry(fields, typ, key)
+    try:
+        changes = _process_entry(ent, **flags)
+    except biblib.FieldError as e:
+        # Nor can errors referring to them, send back the missing field
+        return None, None, ('field', e.args[0])
+    except bibmsg.InputError as e:
+        return None, None, ('input', [msg for pos, msg in e.args[0]])
+    return list(ent.items()), changes, None
+
+def _process_parallel(entries, jobs, flags):
+
+    # Send plain fields to the workers, each with its own abbreviate object
+    items = [(ent.typ, ent.key, list(ent.items())) for ent in entries]
+    with multiprocessing.Pool(jobs or None, initializer=_init_worker,
+                              initargs=(flags['abbrev'],)) as pool:
+        results = pool.imap(functools.partial(_process_fields, **flags),
+                            items, chunksize=32)
+
+        # Copy the processed fields back, in the original order
+        for ent, (fields, changes, error) in zip(entries, results):
+
+            # Raise any error from the workers as if processed here
+            if error:
+                kind, arg = error
+                if kind == 'field':
+                    raise biblib.FieldError(arg, ent)
+                raise bibmsg.InputError([(bibmsg.Pos.unknown, msg) for msg in arg])
+
+            ent.clear()
+            ent.update(fields)
+            yield changes
 
 def main():
 
-    # Yes, I did it this way.
-    global abbreviate
-
     # Create argument parser
     arg_parser = argparse.ArgumentParser(
         description='Abbreviate and shorten journal and conference names and prune ' +
@@ -119,6 +235,10 @@ def main():
     arg_parser.add_argument('-q', '--quiet', default=False, action='store_true',
         help='Suppress printing the changes to the console')
 
+    # Optional argument: number of parallel processes
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='Number of processes to use, or 0 for all CPUs')
+
     # Optional argument: skip abbreviation
     arg_parser.add_argument('-n', '--no-abbrev', dest='abbrev', default=True,
         help='Skip the abbreviation step', action='store_false')
@@ -144,94 +264,41 @@ def main():
     # Load databases
     db = biblib.Parser().parse(args.bib, log_fp=sys.stderr).get_entries()
 
-    # Create an empty file for the output - throws an exception if no write perm
-    f = open(args.outfile,'w')
-    f.close()
-
-    # Create abbreviate object
-    abbreviate = Abbreviate.create()
-
-    # Iterate through the database
-    for ent in db.values():
-
-        # Fields to clear
-        clear = 'shorttitle abstract pages keywords copyright note langid language urldate timestamp file groups'.split()
-
-        # Find empty fields and add to the list
-        for key in ent.keys():
-            if key not in clear and not ent[key]:
-                clear.append(key)
-
-        # Clear unnecessary and empty fields for all entries
-        for key in clear:
-            try: del ent[key]
-            except KeyError: pass
-
-        if ent.typ == 'techreport':
-            # It type not present, use default
-            try:
-                t = bibalg.tex_to_unicode(ent['type'])
-            except biblib.FieldError:
-                t = 'Technical Report'
-
-            # Abbreviate techrep type
-            if args.abbrev: t_abbrev = abbrev_journal(t)
-            else: t_abbrev = t
-
-            ent['type'] = '{' + t_abbrev + '}'
-
-            # Print changes
-            if not args.quiet and t != t_abbrev:
-                t_c, t_abbrev_c = colors.colordiff(t,t_abbrev)
-                print(f'{t_c} -> {t_abbrev_c}')
-
-        if ent.typ == 'article':
-            # Clear additional field for journal articles
-            clear = 'editor publisher'.split()
-            for key in clear:
-                try: del ent[key]
-                except KeyError: pass
-
-            # Abbreviate journal names
-            j = bibalg.tex_to_unicode(ent['journal'])
-            j_abbrev = abbrev_journal(j, args.abbrev)
-            ent['journal'] = j_abbrev
-
-            # Special treatment for ePrints
-            try:
-                if ent['eprint'] + ent['eprinttype'] + ent['primaryclass'] != None:
-                    # Remove the journal field
-                    try: del ent['journal']
-                    except KeyError: pass
-            except biblib.FieldError: pass
-
-            # Print changes
-            if not args.quiet and j != j_abbrev:
-                j_c, j_abbrev_c = colors.colordiff(j,j_abbrev)
-                print(f'{j_c} -> {j_abbrev_c}')
-
-        elif ent.typ == 'inproceedings':
-            # Clear additional field for conference proceedings
-            clear = 'editor publisher address series booktitleaddon eventtitle volume'.split()
-            for key in clear:
-                try: del ent[key]
-                except KeyError: pass
-
-            # Trim and abbreviate conference titles
-            conf = bibalg.tex_to_unicode(ent['booktitle'])
-            conf_abbrev = abbrev_conference(conf,
-                proc=args.proc, annu=args.annu, order=args.order, abbr=args.abbrev)
-            ent['booktitle'] = '{' + conf_abbrev + '}'
-
-            # Print changes
-            if not args.quiet and conf != conf_abbrev:
-                conf_c, conf_abbrev_c = colors.colordiff(conf,conf_abbrev)
-                print(f'{conf_c} -> {conf_abbrev_c}')
-
-        # Write the updated entry to the output
-        with open(args.outfile, 'a') as f:
-            f.write(ent.to_bib())
-            f.write('\n\n')
+    # Options for processing each entry
+    flags = dict(abbrev=args.abbrev, proc=args.proc, annu=args.annu,
+                 order=args.order, quiet=args.quiet)
+
+    # Open the output file once - throws an exception if no write perm
+    with open(args.outfile, 'w', buffering=1<<16) as out:
+
+        # Process the database, in parallel if requested
+        entries = list(db.values())
+        if args.jobs == 1:
+            _init_worker(args.abbrev)
+            results = (_process_entry(ent, **flags) for ent in entries)
+        else:
+            results = _process_parallel(entries, args.jobs, flags)
+
+        # Colors are computed in the workers, but printed from here
+        if not args.quiet:
+            colors.init_colorama()
+
+        log_lines = []
+        for ent, changes in zip(entries, results):
+
+            # Print changes, in batches
+            log_lines.extend(changes)
+            if len(log_lines) >= 100:
+                sys.stdout.write('\n'.join(log_lines) + '\n')
+                log_lines.clear()
+
+            # Write the updated entry to the output
+            out.write(ent.to_bib())
+            out.write('\n\n')
+
+        # Print remaining changes
+        if log_lines:
+            sys.stdout.write('\n'.join(log_lines) + '\n')
 
 if __name__ == '__main__':
     main()
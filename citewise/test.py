@@ -0,0 +1,41 @@
+import unittest
+from .biblib import bib as biblib
+from .biblib import messages as bibmsg
+from . import main
+
+FLAGS = dict(abbrev=False, proc=None, annu=True, order=True, quiet=True)
+
+def entries(string):
+    return list(biblib.Parser().parse(string).get_entries().values())
+
+class ParallelTest(unittest.TestCase):
+    def __test_parallel(self, string):
+        # Process string both serially and in parallel, compare the result
+        serial, parallel = entries(string), entries(string)
+        for ent in serial:
+            main._process_entry(ent, **FLAGS)
+        list(main._process_parallel(parallel, 2, FLAGS))
+        self.assertEqual([e.to_bib() for e in parallel],
+                         [e.to_bib() for e in serial])
+
+    def test_basic(self):
+        self.__test_parallel(
+            '@article{x, title={X}, journal={Nature}, abstract={A}}\n'
+            '@inproceedings{y, title={Y}, booktitle={2020 Conf (C)}}\n'
+            '@techreport{z, title={Z}, institution={MIT}}')
+
+    def test_missing_field(self):
+        with self.assertRaisesRegex(biblib.FieldError, 'journal'):
+            list(main._process_parallel(
+                entries('@article{x, title={X}, year={2020}}'), 2, FLAGS))
+        with self.assertRaisesRegex(biblib.FieldError, 'booktitle'):
+            list(main._process_parallel(
+                entries('@inproceedings{x, title={X}}'), 2, FLAGS))
+
+    def test_input_error(self):
+        with self.assertRaises(bibmsg.InputError):
+            list(main._process_parallel(
+                entries('@article{x, title={X}, journal={\\foo Bar}}'), 2, FLAGS))
+
+if __name__ == '__main__':
+    unittest.main()